@@ -1,12 +1,18 @@
 from dataclasses import dataclass
 from typing import Optional
-import requests
-from datetime import datetime
+import asyncio
+import aiohttp
+import orjson
+import random
+import time
 from dotenv import load_dotenv
 import os
 import sqlite3
 from enum import Enum
 import logging
+import atexit
+import functools
+import signal
 
 logging.basicConfig(
     level=logging.DEBUG,  # Set the minimum level to log
@@ -15,6 +21,9 @@ logging.basicConfig(
     filemode='a'
 )
 
+# 启动时读取一次 .env，之后的配置项（token、轮询间隔、站点）都从环境变量获取
+load_dotenv()
+
 class AQILevel(Enum):
     GOOD = (0, 50, "Good")
     MODERATE = (51, 100, "Moderate")
@@ -25,136 +34,299 @@ class AQILevel(Enum):
 
     @classmethod
     def get_level(cls, aqi: int) -> 'AQILevel':
-        for level in cls:
-            if level.value[0] <= aqi <= level.value[1]:
-                return level
-        return cls.HAZARDOUS
+        return _AQI_LUT[aqi] if 0 <= aqi <= 500 else cls.HAZARDOUS
+
+# 预先计算 0-500 每个AQI值对应的等级，get_level 直接查表
+_AQI_LUT: list[AQILevel] = [AQILevel.HAZARDOUS] * 501
+for _level in AQILevel:
+    _lo, _hi = _level.value[0], _level.value[1]
+    _AQI_LUT[_lo:_hi + 1] = [_level] * (_hi - _lo + 1)
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class AQIResponse:
     aqi: int
-    time: datetime
+    time: str  # ISO-8601 字符串，直接存入数据库
     station: str
     dominentpol: str
     
     @classmethod
     def from_response(cls, data: dict) -> 'AQIResponse':
         return cls(
-            aqi=data['aqi'],
-            time=datetime.fromisoformat(data['time']['iso']),
+            aqi=int(data['aqi']),
+            time=data['time']['iso'],
             station=data['city']['name'],
             dominentpol=data['dominentpol']
         )
 
-def adapt_datetime(val: datetime) -> str:
-    """将datetime转换为SQLite存储格式"""
-    return val.isoformat()
+# 接口地址与SQL语句
+URL_TMPL = "https://api.waqi.info/feed/{}/?token={}"
+SQL_CREATE_TABLE = '''
+    CREATE TABLE IF NOT EXISTS aqi_records (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp TEXT,
+        aqi INTEGER,
+        level TEXT,
+        station TEXT,
+        dominentpol TEXT
+    )
+'''
+SQL_CREATE_INDEX = 'CREATE INDEX IF NOT EXISTS idx_aqi_station_ts ON aqi_records(station, timestamp DESC)'
+SQL_LAST_RECORD = 'SELECT timestamp, aqi, level FROM aqi_records WHERE station = ? ORDER BY timestamp DESC LIMIT 1'
+SQL_INSERT = 'INSERT INTO aqi_records (timestamp, aqi, level, station, dominentpol) VALUES (?, ?, ?, ?, ?)'
+
+def _configure(conn: sqlite3.Connection) -> sqlite3.Connection:
+    """为新连接设置PRAGMA（WAL模式等），每个连接都需要调用"""
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-8000')
+    conn.execute('PRAGMA mmap_size=268435456')
+    return conn
+
+# 全局共享的数据库连接，进程退出时关闭
+_CONN = _configure(sqlite3.connect('aqi_history.db', check_same_thread=False))
+atexit.register(_CONN.close)
 
-def convert_datetime(val: bytes) -> datetime:
-    """从SQLite格式转换回datetime"""
-    return datetime.fromisoformat(val.decode())
+def get_conn() -> sqlite3.Connection:
+    """获取共享的数据库连接"""
+    return _CONN
 
 def init_db():
     """初始化SQLite数据库"""
-    # 注册datetime适配器
-    sqlite3.register_adapter(datetime, adapt_datetime)
-    sqlite3.register_converter("datetime", convert_datetime)
-    
-    conn = sqlite3.connect('aqi_history.db', detect_types=sqlite3.PARSE_DECLTYPES)
+    conn = get_conn()
     c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS aqi_records (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp datetime,
-            aqi INTEGER,
-            level TEXT,
-            station TEXT,
-            dominentpol TEXT
-        )
-    ''')
+    c.execute(SQL_CREATE_TABLE)
+    # 按站点+时间倒序索引，get_last_record 只需定位该站点最新的叶子节点
+    c.execute(SQL_CREATE_INDEX)
     conn.commit()
-    conn.close()
 
-def get_last_record() -> Optional[tuple]:
-    """获取最后一条记录"""
-    conn = sqlite3.connect('aqi_history.db', detect_types=sqlite3.PARSE_DECLTYPES)
+def get_last_record(c: sqlite3.Cursor, station: str) -> Optional[tuple]:
+    """获取指定站点的最后一条记录"""
+    c.execute(SQL_LAST_RECORD, (station,))
+    return c.fetchone()
+
+# 待写入的数据缓冲，每轮轮询结束时一次性提交
+_PENDING: list[AQIResponse] = []
+
+def flush_pending():
+    """将缓冲中的数据批量写入数据库并检查等级变化"""
+    if not _PENDING:
+        return
+
+    conn = get_conn()
     c = conn.cursor()
-    c.execute('SELECT aqi, level FROM aqi_records ORDER BY timestamp DESC LIMIT 1')
-    result = c.fetchone()
-    conn.close()
-    return result
+    rows = []
+    changes = []
+    # 查询上一条记录与写入新记录放在同一个事务内
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        last_records = {}
+        for data in _PENDING:
+            if data.station not in last_records:
+                last_records[data.station] = get_last_record(c, data.station)
+            last_record = last_records[data.station]
+            level = AQILevel.get_level(data.aqi)
+
+            # 数据未更新（服务端时间相同）则不重复存储
+            if last_record and last_record[0] == data.time:
+                logging.info("数据未更新，跳过存储: %s %s", data.station, data.time)
+                continue
+
+            rows.append((data.time, data.aqi, level.name, data.station, data.dominentpol))
+            last_records[data.station] = rows[-1][:3]
+            changes.append((data, last_record[2] if last_record else None, level.name))
+
+        c.executemany(SQL_INSERT, rows)
+        conn.commit()
+    except BaseException:
+        # 包括 SIGTERM 触发的 SystemExit，保证回滚后缓冲仍可在退出时重新写入
+        conn.rollback()
+        raise
+    _PENDING.clear()
+
+    for data, last_level, level_name in changes:
+        if last_level and last_level != level_name:
+            notify_level_change(data, last_level, level_name)
+        else:
+            logging.info("没有监测到跳变，当前AQI: %s %s", data.aqi, level_name)
+
+# 在关闭连接之前执行（atexit 按注册的逆序调用）
+atexit.register(flush_pending)
+
+def _handle_sigterm(signum, frame):
+    """收到 SIGTERM 时正常退出，使 atexit 中的 flush_pending 得以执行"""
+    logging.info("收到 SIGTERM，写入缓冲数据后退出")
+    raise SystemExit(128 + signum)
 
 def notify_level_change(data: AQIResponse, old_level: str, new_level: str):
-    logging.info(f"监测到AQI跳变：{old_level} -> {new_level}")
+    logging.info("监测到AQI跳变：%s -> %s", old_level, new_level)
 
     message = f"当前AQI: {data.aqi} {new_level}, 主要污染物: {data.dominentpol}"
-    logging.info(f"准备发送邮件通知：{message}")
+    logging.info("准备发送邮件通知：%s", message)
 
     # TODO: send_email(message)
     print( message )
 
 def store_aqi(data: AQIResponse):
-    """存储AQI数据并检查等级变化"""
-    level = AQILevel.get_level(data.aqi)
-    
-    # 获取上一条记录
-    last_record = get_last_record()
-    
-    # 存储新记录
-    conn = sqlite3.connect('aqi_history.db', detect_types=sqlite3.PARSE_DECLTYPES)
-    c = conn.cursor()
-    c.execute('''
-        INSERT INTO aqi_records (timestamp, aqi, level, station, dominentpol)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (data.time, data.aqi, level.name, data.station, data.dominentpol))
-    conn.commit()
-    conn.close()
-    
-    if last_record and last_record[1] != level.name:
-        notify_level_change(data, last_record[1], level.name)
-    else:
-        logging.info(f"没有监测到跳变，当前AQI: {data.aqi} {level.name}")
-
-def get_aqi(token: str) -> AQIResponse:
-    """获取浦东惠南的AQI数据"""
-    url = f"https://api.waqi.info/feed/shanghai/pudonghuinan/?token={token}"
+    """缓冲AQI数据，由 flush_pending 统一写入并检查等级变化"""
+    _PENDING.append(data)
+
+# 轮询间隔（秒），为0时只获取一次后退出
+POLL_INTERVAL = 0
+
+def _get_interval() -> int:
+    """获取轮询间隔，配置无效时使用默认值"""
+    value = os.getenv("AQI_POLL_INTERVAL")
+    if value is None:
+        return POLL_INTERVAL
+    try:
+        return int(value)
+    except ValueError:
+        logging.error("AQI_POLL_INTERVAL 配置无效: %r，使用默认值 %s", value, POLL_INTERVAL)
+        return POLL_INTERVAL
+
+# 默认监测的站点，可通过 AQI_STATIONS（逗号分隔）覆盖
+STATIONS = ["shanghai/pudonghuinan"]
+
+# 被限流时的重试次数与退避时间（秒）
+MAX_RETRIES = 3
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+class TokenBucket:
+    """令牌桶限流，每次请求前获取一个令牌"""
+
+    def __init__(self, capacity: int, refill_rate: float):
+        self.capacity = capacity
+        self.refill_rate = refill_rate  # 每秒补充的令牌数
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.refill_rate)
+
+_BUCKET = TokenBucket(capacity=5, refill_rate=1.0)
+
+# 接口响应缓存（按站点），CACHE_TTL 秒内直接返回上次结果
+CACHE_TTL = 60
+_CACHE: dict[str, tuple[float, AQIResponse]] = {}
+
+def _is_rate_limited(status: int, data: dict) -> bool:
+    """判断是否被API限流（HTTP 429 或返回 quota 错误）"""
+    if status == 429:
+        return True
+    return data.get('status') != 'ok' and 'quota' in str(data.get('data')).lower()
+
+async def get_aqi(session: aiohttp.ClientSession, station: str, token: str) -> AQIResponse:
+    """获取指定站点的AQI数据"""
+    cached = _CACHE.get(station)
+    if cached and time.monotonic() - cached[0] < CACHE_TTL:
+        return cached[1]
+
+    url = URL_TMPL.format(station, token)
     
-    response = requests.get(url)
-    data = response.json()
+    for attempt in range(MAX_RETRIES + 1):
+        await _BUCKET.acquire()
+        async with session.get(url) as response:
+            status = response.status
+            data = {} if status == 429 else orjson.loads(await response.read())
+
+        # 网关错误页等非预期响应体按单个站点的错误处理
+        if not isinstance(data, dict):
+            logging.error("API返回数据格式错误: %r", data)
+            raise ValueError(f"API返回数据格式错误: {data!r}")
+
+        if not _is_rate_limited(status, data) or attempt == MAX_RETRIES:
+            break
+
+        # 指数退避 + 随机抖动
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt + random.uniform(0, BACKOFF_BASE))
+        logging.warning("API限流，%.1f秒后重试 (%d/%d)", delay, attempt + 1, MAX_RETRIES)
+        await asyncio.sleep(delay)
     
-    if data['status'] != 'ok':
-        logging.error(f"API返回错误: {data.get('data')}")
+    if status == 429:
+        logging.error("API返回错误: 请求过于频繁")
+        raise ValueError("API返回错误: 请求过于频繁")
+
+    if data.get('status') != 'ok':
+        logging.error("API返回错误: %s", data.get('data'))
         raise ValueError(f"API返回错误: {data.get('data')}")
         
-    return AQIResponse.from_response(data['data'])
+    # 数据格式异常（缺少字段、AQI为"-"等）按单个站点的错误处理
+    try:
+        result = AQIResponse.from_response(data['data'])
+    except (KeyError, TypeError, ValueError) as e:
+        logging.error("API返回数据格式错误: %r", e)
+        raise ValueError(f"API返回数据格式错误: {e!r}") from e
+    _CACHE[station] = (time.monotonic(), result)
+    return result
+
+async def main(token: str, stations: list[str], interval: int):
+    # 同一个会话内复用连接，按间隔持续轮询
+    timeout = aiohttp.ClientTimeout(total=10)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        while True:
+            # 所有站点并发请求，单个站点失败不影响其他站点
+            tasks = [get_aqi(session, station, token) for station in stations]
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+
+            for station, result in zip(stations, results):
+                if isinstance(result, (aiohttp.ClientError, asyncio.TimeoutError, ValueError)):
+                    print(f"错误: {station}: {str(result)}") 
+                    logging.error("错误: %s: %s", station, result)
+                    continue
+                if isinstance(result, BaseException):
+                    raise result
+
+                # 存储数据并检查等级变化
+                store_aqi(result)
+                
+                # 打印当前状态
+                level = AQILevel.get_level(result.aqi)
+                print(f"\n{station} AQI:")
+                print(f"站点: {result.station}")
+                print(f"AQI: {result.aqi}")
+                print(f"等级: {level.name} ({level.value[2]})")
+                print(f"主要污染物: {result.dominentpol}")
+                print(f"更新时间: {result.time}")
+
+                logging.info("成功获取%s AQI: %s", result.station, result.aqi)
+                logging.info("主要污染物: %s", result.dominentpol)
+
+            # 本轮所有站点的数据在同一个事务中写入，失败时保留缓冲到下一轮
+            try:
+                flush_pending()
+            except sqlite3.Error as e:
+                print(f"错误: 写入数据库失败: {str(e)}")
+                logging.error("错误: 写入数据库失败: %s", e)
+
+            if interval <= 0:
+                break
+            await asyncio.sleep(interval)
+
+@functools.lru_cache(maxsize=1)
+def _get_token() -> Optional[str]:
+    """获取API token，首次读取后缓存"""
+    return os.getenv("AQICN_TOKEN")
 
 # 使用示例
 if __name__ == "__main__":
     logging.info("\n\n====")
 
-    load_dotenv()
-    TOKEN = os.getenv("AQICN_TOKEN")
+    TOKEN = _get_token()
+    INTERVAL = _get_interval()
+    stations_env = os.getenv("AQI_STATIONS")
+    stations = [s.strip() for s in stations_env.split(",") if s.strip()] if stations_env else STATIONS
     
     # 确保数据库已初始化
     init_db()
+    signal.signal(signal.SIGTERM, _handle_sigterm)
     
-    try:
-        result = get_aqi(TOKEN)
-        # 存储数据并检查等级变化
-        store_aqi(result)
-        
-        # 打印当前状态
-        level = AQILevel.get_level(result.aqi)
-        print(f"\n浦东惠南AQI:")
-        print(f"站点: {result.station}")
-        print(f"AQI: {result.aqi}")
-        print(f"等级: {level.name} ({level.value[2]})")
-        print(f"主要污染物: {result.dominentpol}")
-        print(f"更新时间: {result.time}")
-
-        logging.info(f"成功获取浦东惠南AQI: {result.aqi}")
-        logging.info(f"主要污染物: {result.dominentpol}")
-
-    except (requests.RequestException, ValueError) as e:
-        print(f"错误: {str(e)}") 
-        logging.error(f"错误: {str(e)}")
\ No newline at end of file
+    asyncio.run(main(TOKEN, stations, INTERVAL))